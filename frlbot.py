@@ -58,8 +58,13 @@ def scheduler_loop():
     """Thread to handle the scheduler"""
     logging.info("Starting scheduler loop")
     while True:
+        # Sleep until the next job is due
+        idle_seconds = schedule.idle_seconds()
+        if idle_seconds is None:
+            time.sleep(60)
+        elif idle_seconds > 0:
+            time.sleep(idle_seconds)
         schedule.run_pending()
-        time.sleep(5)
 
 
 # Check inputs from Telegram APIs
@@ -1,5 +1,9 @@
 """Telegram bot instance holder and initialization."""
 
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import telebot
 
 from . import config
@@ -7,10 +11,42 @@ from . import config
 # Shared Telegram bot instance (initialized at startup via init_bot)
 telegram_bot: telebot.TeleBot = None
 
+# Maximum rate of the queued messages, Telegram allows about 30 messages per second
+MAX_MESSAGES_PER_SECOND = 25
+
+# Single worker queue for the outgoing messages, keeps them in order
+_send_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="TelegramSender")
+_last_send_time = 0.0
+
 
 # Bot initialization
 def init_bot() -> telebot.TeleBot:
     """Initialize the Telegram bot class"""
     global telegram_bot
-    telegram_bot = telebot.TeleBot(config.get_bot_api_from_env())
+    # Handlers only dispatch the commands to the workers pool, no need for telebot's own worker threads
+    telegram_bot = telebot.TeleBot(config.get_bot_api_from_env(), threaded=False)
     return telegram_bot
+
+
+# Call the bot APIs respecting the rate limit
+def _rate_limited_call(method_name: str, args: tuple, kwargs: dict):
+    """Wait for the rate limit, then call the bot API (runs on the sender thread)"""
+    global _last_send_time
+    time.sleep(max(0, 1 / MAX_MESSAGES_PER_SECOND - (time.monotonic() - _last_send_time)))
+    _last_send_time = time.monotonic()
+    return getattr(telegram_bot, method_name)(*args, **kwargs)
+
+
+# Log errors of the queued calls
+def _log_send_errors(send_future: Future) -> None:
+    """Report exceptions raised by a queued call"""
+    if send_future.exception() is not None:
+        logging.error("Cannot send message: " + str(send_future.exception()))
+
+
+# Queue a message
+def send(method_name: str, *args, **kwargs) -> Future:
+    """Queue a call to the bot API (such as reply_to or send_document) and return its future"""
+    send_future = _send_pool.submit(_rate_limited_call, method_name, args, kwargs)
+    send_future.add_done_callback(_log_send_errors)
+    return send_future
@@ -2,6 +2,7 @@
 
 import logging
 import os
+from functools import lru_cache
 
 # Runtime flags (mutated at startup from the CLI arguments)
 dry_run = False
@@ -62,7 +63,8 @@ def get_target_chat_from_env() -> int:
     return int(BOT_TARGET)
 
 
-# Get admin chat from ENV
+# Get admin chat from ENV (read once, flags must be set before the first call)
+@lru_cache(maxsize=1)
 def get_admin_chat_from_env() -> int:
     """Return the admin chat ID from environment variables"""
     if dry_run:
@@ -1,7 +1,9 @@
 """Core publishing loop: fetch news and send them to Telegram."""
 
 import logging
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime
 
 import emoji
 
@@ -11,82 +13,120 @@ from . import database
 from .feeds import parse_news
 from .translation import translate_text
 
+# Emojis used in the messages
+EMOJI_FLAG_IT = emoji.emojize(":Italy:", language="alias")
+EMOJI_FLAG_EN = emoji.emojize(":United_States:", language="alias")
+EMOJI_PENCIL = emoji.emojize(":pencil2:", language="alias")
+EMOJI_CALENDAR = emoji.emojize(":spiral_calendar:", language="alias")
+EMOJI_LINK = emoji.emojize(":link:", language="alias")
+
+# Workers used to run the translations of each language concurrently
+_translation_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="Translation")
+# Held while news are being published, so overlapping runs cannot send the same articles
+_main_lock = threading.Lock()
+# Seconds to wait for the translations of an article before sending the original text
+TRANSLATION_TIMEOUT = 30
+
+
+# Wait for a translation
+def _translation_result(translation, single_news) -> list[str]:
+    """Return the translated title and summary, or the original ones if the translation takes too long"""
+    try:
+        return translation.result(timeout=TRANSLATION_TIMEOUT)
+    except TimeoutError:
+        logging.error("Translation of [" + single_news.link + "] timed out, sending original text")
+        return [single_news.title, single_news.summary]
+
 
 # Main code
 def main():
-    """Main robot code"""
+    """Main robot code, skipped if another execution is in progress"""
+    if not _main_lock.acquire(blocking=False):
+        logging.warning("Another execution is in progress, skipping this one")
+        return
+    try:
+        _publish_news()
+    finally:
+        _main_lock.release()
+
+
+# Publish the news
+def _publish_news():
+    """Send the news which were not sent yet"""
     logging.info("Starting bot")
     # Track how many news we sent
     news_cnt: int = 0
     max_news = config.get_max_news_cnt_from_env()
+    try:
+        target_chat = config.get_target_chat_from_env()
+    except Exception as returned_exception:
+        logging.error("Cannot get target chat: " + str(returned_exception))
+        return
     # Get SQL cursor
     sql_connector = database.get_sql_connector()
     # Clean data from DB
-    feeds_from_db = [x[0] for x in sql_connector.cursor().execute("SELECT url FROM feeds WHERE 1").fetchall()]
+    feeds_from_db = [x[0] for x in sql_connector.cursor().execute(database.SQL_LIST_FEED_URLS).fetchall()]
     if feeds_from_db is None:
         logging.error("No news from DB")
-        sql_connector.close()
         return
     logging.debug("Fetching [" + str(len(feeds_from_db)) + "] feeds")
     # Monitor exceptions and report in case of multiple errors
     exception_cnt = 0
     exception_message = ""
-    # Get news from feed
-    for single_news in parse_news(feeds_from_db):
-        # Check if we already sent this message
-        if sql_connector.cursor().execute("SELECT * FROM news WHERE checksum='" + single_news.checksum + "'").fetchone() is None:
+    # News to be stored to DB at the end of the execution
+    news_to_store = []
+    try:
+        # Get news from feed, skipping the ones which were already sent
+        for single_news in parse_news(feeds_from_db, database.get_sent_checksums):
             logging.info("Sending: [" + single_news.link + "]")
-            # Check if article is no more than 30 days
-            if datetime.now().replace(tzinfo=None) - single_news.date.replace(tzinfo=None) > timedelta(days=30):
-                logging.debug("Article: [" + single_news.link + "] is older than 30 days, skipping")
-            elif single_news.date.replace(tzinfo=None) > datetime.now().replace(tzinfo=None):
+            # Articles older than the maximum age are already skipped by parse_news
+            if single_news.date.replace(tzinfo=None) > datetime.now().replace(tzinfo=None):
                 logging.warning("Article: [" + single_news.link + "] is coming from the future?!")
             else:
                 # Prepare message to send
-                emoji_flag_it = emoji.emojize(":Italy:", language="alias")
-                emoji_flag_en = emoji.emojize(":United_States:", language="alias")
-                emoji_pencil = emoji.emojize(":pencil2:", language="alias")
-                emoji_calendar = emoji.emojize(":spiral_calendar:", language="alias")
-                emoji_link = emoji.emojize(":link:", language="alias")
                 try:
-                    telegram_payload = f"{emoji_flag_it} {translate_text(single_news.title, 'it')}\n" + \
-                                        f"{emoji_flag_en} {translate_text(single_news.title, 'en')}\n" + \
-                                        f"\n{emoji_pencil} {single_news.author}\n" + \
-                                        f"{emoji_calendar} {single_news.date.strftime('%Y/%m/%d, %H:%M')}\n" + \
-                                        f"\n{emoji_flag_it} {translate_text(single_news.summary, 'it')}\n" + \
-                                        f"\n{emoji_flag_en} {translate_text(single_news.summary, 'en')}\n" + \
-                                        f"\n{emoji_link} {single_news.link}"
+                    # Translate title and summary with one concurrent request per language
+                    translation_it = _translation_pool.submit(translate_text, [single_news.title, single_news.summary], 'it')
+                    translation_en = _translation_pool.submit(translate_text, [single_news.title, single_news.summary], 'en')
+                    title_it, summary_it = _translation_result(translation_it, single_news)
+                    title_en, summary_en = _translation_result(translation_en, single_news)
+                    telegram_payload = f"{EMOJI_FLAG_IT} {title_it}\n" + \
+                                        f"{EMOJI_FLAG_EN} {title_en}\n" + \
+                                        f"\n{EMOJI_PENCIL} {single_news.author}\n" + \
+                                        f"{EMOJI_CALENDAR} {single_news.date.strftime('%Y/%m/%d, %H:%M')}\n" + \
+                                        f"\n{EMOJI_FLAG_IT} {summary_it}\n" + \
+                                        f"\n{EMOJI_FLAG_EN} {summary_en}\n" + \
+                                        f"\n{EMOJI_LINK} {single_news.link}"
                     if not config.dry_run:
-                        bot.telegram_bot.send_message(config.get_target_chat_from_env(), telegram_payload, parse_mode="MARKDOWN")
+                        bot.telegram_bot.send_message(target_chat, telegram_payload, parse_mode="MARKDOWN")
                     else:
                         logging.info(telegram_payload)
                     if not config.dry_run:
                         # Store this article to DB
                         logging.debug("Adding [" + single_news.checksum + "] to store")
-                        sql_connector.cursor().execute("INSERT INTO news(date, checksum) VALUES(?, ?)", [single_news.date, single_news.checksum])
-                        sql_connector.commit()
+                        news_to_store.append((single_news.date, single_news.checksum))
                     news_cnt += 1
                 except Exception as returned_exception:
                     exception_message = str(returned_exception)
                     logging.error(exception_message)
                     if "can\'t parse entities:" in exception_message:
                         logging.warning("Skipping [" + single_news.checksum + "] due to Telegram parsing error")
-                        sql_connector.cursor().execute("INSERT INTO news(date, checksum) VALUES(?, ?)", [single_news.date, single_news.checksum])
-                        sql_connector.commit()
+                        news_to_store.append((single_news.date, single_news.checksum))
                     else:
                         exception_cnt += 1
-        # This message was already posted
-        else:
-            logging.debug("Post at [" + single_news.link + "] was already sent")
-        # Check errors count
-        if exception_cnt > 3:
-            logging.error("Too many errors, skipping this upgrade")
-            if not config.dry_run:
-                bot.telegram_bot.send_message(config.get_admin_chat_from_env(), "Too many errors, skipping this execution. Last error: `" + exception_message + "`")
-            break
-        # Stop execution after sending x elements
-        if news_cnt >= max_news:
-            break
+            # Check errors count
+            if exception_cnt > 3:
+                logging.error("Too many errors, skipping this upgrade")
+                if not config.dry_run:
+                    bot.telegram_bot.send_message(config.get_admin_chat_from_env(), "Too many errors, skipping this execution. Last error: `" + exception_message + "`")
+                break
+            # Stop execution after sending x elements
+            if news_cnt >= max_news:
+                break
+    finally:
+        # Store processed articles with a single commit, also when the loop is interrupted by an error
+        if news_to_store:
+            logging.debug("Storing [" + str(len(news_to_store)) + "] news to DB")
+            with sql_connector:
+                sql_connector.executemany(database.SQL_INS_NEWS, news_to_store)
     logging.debug("No more articles to process, waiting for next execution")
-    # Close DB connection
-    sql_connector.close()
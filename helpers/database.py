@@ -1,17 +1,55 @@
 """SQLite persistence layer: feeds and sent-news storage."""
 
+import io
 import logging
 import sqlite3
+import threading
 import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
 
 from . import config
-from .feeds import valid_xml
+from . import feeds
+
+
+# Statements shared by the handlers and the scheduled job
+SQL_LIST_FEEDS = "SELECT rowid, url FROM feeds ORDER BY rowid"
+SQL_LIST_FEED_URLS = "SELECT url FROM feeds"
+SQL_DEL_FEED = "DELETE FROM feeds WHERE rowid=?"
+SQL_INS_FEED = "INSERT OR IGNORE INTO feeds(url) VALUES(?)"
+SQL_INS_FEED_RETURNING = SQL_INS_FEED + " RETURNING rowid"
+SQL_INS_NEWS = "INSERT INTO news(date, checksum) VALUES(?, ?)"
+# Bound parameters used by a single IN (...) lookup
+SQL_MAX_PARAMETERS = 900
+
+# Connections opened by each thread
+_thread_connections = threading.local()
 
 
 # Get SQL Connector
 def get_sql_connector() -> sqlite3.Connection:
-    """Connect to sqlite"""
-    return sqlite3.connect("store/frlbot.db", timeout=5)
+    """Return the sqlite connection of the current thread, connect if needed"""
+    sqlCon = getattr(_thread_connections, "connection", None)
+    if sqlCon is None:
+        # Wait for locks held by other threads instead of failing right away
+        sqlCon = sqlite3.connect("store/frlbot.db", timeout=60)
+        # Per-connection tuning (journal mode is set once in prepare_db)
+        sqlCon.execute("PRAGMA synchronous=NORMAL")
+        sqlCon.execute("PRAGMA cache_size=-65536")
+        sqlCon.execute("PRAGMA temp_store=MEMORY")
+        sqlCon.execute("PRAGMA mmap_size=268435456")
+        _thread_connections.connection = sqlCon
+    return sqlCon
+
+
+# Make a copy of the database
+def backup_db(backup_path: str) -> None:
+    """Write a consistent snapshot of the sqlite store to the specified path"""
+    sqlCon = get_sql_connector()
+    backupCon = sqlite3.connect(backup_path)
+    # Copy in small steps so other threads can keep writing
+    with backupCon:
+        sqlCon.backup(backupCon, pages=1000, sleep=0.001)
+    backupCon.close()
 
 
 # Database preparation
@@ -21,12 +59,17 @@ def prepare_db() -> None:
     logging.debug("Opening SQLite store")
     sqliteConn = get_sql_connector()
     sqliteCursor = sqliteConn.cursor()
+    # Allow readers and writers from different threads to work concurrently, this is stored in the DB file
+    sqliteCursor.execute("PRAGMA journal_mode=WAL")
     # Create news table
     try:
         sqliteCursor.execute("CREATE TABLE news(date, checksum)")
         logging.info("News table was generated successfully")
     except:
         logging.debug("News table already exists")
+    # Create news indexes
+    sqliteCursor.execute("CREATE INDEX IF NOT EXISTS idx_news_checksum ON news(checksum)")
+    sqliteCursor.execute("CREATE INDEX IF NOT EXISTS idx_news_date ON news(date)")
     # Count sent articles
     try:
         data_from_db = sqliteCursor.execute("SELECT checksum FROM news WHERE 1").fetchall()
@@ -40,8 +83,26 @@ def prepare_db() -> None:
         logging.info("Feeds table was generated successfully")
     except:
         logging.debug("Feeds table already exists")
+    # Remove exact duplicates, then make sure no more can be added
+    deletedFeeds = sqliteCursor.execute("DELETE FROM feeds WHERE rowid NOT IN (SELECT MIN(rowid) FROM feeds GROUP BY url)").rowcount
+    sqliteConn.commit()
+    if deletedFeeds > 0:
+        logging.info("Removed [" + str(deletedFeeds) + "] duplicated feeds")
+    sqliteCursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_feeds_url ON feeds(url)")
+    # Create feeds cache table (used for conditional GET requests)
+    try:
+        sqliteCursor.execute("CREATE TABLE feed_cache(url PRIMARY KEY, etag, last_modified, body)")
+        logging.info("Feed cache table was generated successfully")
+    except:
+        logging.debug("Feed cache table already exists")
+    # Create translations table
+    try:
+        sqliteCursor.execute("CREATE TABLE translations(hash TEXT PRIMARY KEY, lang TEXT, text TEXT)")
+        logging.info("Translations table was generated successfully")
+    except:
+        logging.debug("Translations table already exists")
     # Get feeds from DB
-    data_from_db = sqliteCursor.execute("SELECT url FROM feeds WHERE 1").fetchall()
+    data_from_db = sqliteCursor.execute(SQL_LIST_FEED_URLS).fetchall()
     if (len(data_from_db) < 1):
         logging.info("News table is empty, adding default")
         try:
@@ -49,16 +110,15 @@ def prepare_db() -> None:
                 logging.debug("Adding [" + single_url + "]")
                 sqliteCursor.execute("INSERT INTO feeds(url) VALUES(?)", [single_url])
             sqliteConn.commit()
-            if (len(sqliteCursor.execute("SELECT url FROM feeds WHERE 1").fetchall()) < 1):
+            if (len(sqliteCursor.execute(SQL_LIST_FEED_URLS).fetchall()) < 1):
                 raise Exception("Records were not added!")
             logging.debug("Default records were added")
         except Exception as returned_exception:
+            sqliteConn.rollback()
             logging.error(returned_exception)
             return
     else:
         logging.info("Feeds table contains [" + str(len(data_from_db)) + "] records")
-    # Close DB connection
-    sqliteConn.close()
 
 
 # Delete old SQLite records
@@ -69,50 +129,147 @@ def remove_old_news(max_days: int = -1) -> int:
     try:
         # Get SQL cursor
         sqlCon = get_sql_connector()
-        oldNews = sqlCon.cursor().execute("SELECT date FROM news WHERE date <= date('now', '-" + str(max_days) + " day')").fetchall()
-        logging.info("Removing [" + str(len(oldNews)) + "] old news from DB")
-        sqlCon.cursor().execute("DELETE FROM news WHERE date <= date('now', '-" + str(max_days) + " day')")
-        sqlCon.commit()
-        sqlCon.close()
-        return len(oldNews)
+        # Dates are stored as datetime objects, compare with the same format so the index can be used
+        cutoff_date = datetime.now() - timedelta(days=max_days)
+        with sqlCon:
+            deletedNews = sqlCon.execute("DELETE FROM news WHERE date <= ?", [cutoff_date]).rowcount
+        logging.info("Removed [" + str(deletedNews) + "] old news from DB")
+        return deletedNews
     except Exception as returned_exception:
         logging.error("Cannot delete older news. " + str(returned_exception))
         return -1
 
 
+# Get news which were already sent
+def get_sent_checksums(checksums: list[str]) -> set[str]:
+    """Return which of the checksums are already stored in the news table"""
+    sqlCon = get_sql_connector()
+    sent_checksums = set()
+    # Query in chunks, older SQLite builds accept at most 999 bound parameters per statement
+    for chunk_start in range(0, len(checksums), SQL_MAX_PARAMETERS):
+        checksums_chunk = checksums[chunk_start:chunk_start + SQL_MAX_PARAMETERS]
+        placeholders = ",".join("?" * len(checksums_chunk))
+        sent_checksums.update(x[0] for x in sqlCon.execute(f"SELECT checksum FROM news WHERE checksum IN ({placeholders})", checksums_chunk))
+    return sent_checksums
+
+
+# Get cached validators of a feed
+def get_cached_headers(feed_url: str) -> tuple[str, str]:
+    """Return the ETag and Last-Modified values stored for the feed"""
+    sqlCon = get_sql_connector()
+    cached_row = sqlCon.execute("SELECT etag, last_modified FROM feed_cache WHERE url=?", [feed_url]).fetchone()
+    if cached_row is None:
+        return None, None
+    return cached_row[0], cached_row[1]
+
+
+# Get cached content of a feed
+def get_cached_body(feed_url: str) -> bytes:
+    """Return the last downloaded content of the feed"""
+    sqlCon = get_sql_connector()
+    cached_row = sqlCon.execute("SELECT body FROM feed_cache WHERE url=?", [feed_url]).fetchone()
+    if cached_row is None:
+        return None
+    return cached_row[0]
+
+
+# Store validators and content of a feed
+def store_feed_cache(feed_url: str, etag: str, last_modified: str, body: bytes) -> None:
+    """Save the last response of the feed for the next conditional request"""
+    sqlCon = get_sql_connector()
+    with sqlCon:
+        sqlCon.execute("INSERT OR REPLACE INTO feed_cache(url, etag, last_modified, body) VALUES(?, ?, ?, ?)", [feed_url, etag, last_modified, body])
+
+
+# Get stored translation
+def get_translation(translation_key: str) -> str:
+    """Return the translated text stored with the specified key"""
+    sqlCon = get_sql_connector()
+    stored_row = sqlCon.execute("SELECT text FROM translations WHERE hash=?", [translation_key]).fetchone()
+    if stored_row is None:
+        return None
+    return stored_row[0]
+
+
+# Store translation
+def store_translation(translation_key: str, dest_lang: str, translated_text: str) -> None:
+    """Save the translated text for future executions"""
+    sqlCon = get_sql_connector()
+    with sqlCon:
+        sqlCon.execute("INSERT OR REPLACE INTO translations(hash, lang, text) VALUES(?, ?, ?)", [translation_key, dest_lang, translated_text])
+
+
 # Add feed to database if not duplicated
 def add_feed_if_not_duplicate(feed_url) -> bool:
     """Adds the RSS feed only if valid"""
     sqlCon = get_sql_connector()
-    if sqlCon.execute("SELECT * FROM feeds WHERE url=?", [feed_url]).fetchone() is not None:
-        logging.warning("Duplicate URL [" + feed_url + "]")
-        return False
-    else:
-        try:
-            logging.info("Adding [" + feed_url + "] to DB")
-            if valid_xml(feed_url):
-                sqlCon.execute("INSERT INTO feeds(url) VALUES(?)", [feed_url])
-                logging.debug("Added [" + feed_url + "] to DB")
+    try:
+        # Validate the feed before storing it, so it is never fetched by the scheduler if not valid
+        logging.info("Adding [" + feed_url + "] to DB")
+        if not feeds.valid_xml(feed_url):
+            logging.warning("RSS feed [" + feed_url + "] cannot be validated")
+            return False
+        # The unique index on the URL skips duplicates
+        with sqlCon:
+            if sqlite3.sqlite_version_info >= (3, 35, 0):
+                # A returned row means the feed was inserted
+                insertedRows = sqlCon.execute(SQL_INS_FEED_RETURNING, [feed_url]).fetchall()
+                feedIndex = insertedRows[0][0] if insertedRows else None
             else:
-                logging.warning("RSS feed [" + feed_url + "] cannot be validated")
-                return False
-        except Exception as retExc:
-            logging.warning(retExc)
+                sqlCursor = sqlCon.execute(SQL_INS_FEED, [feed_url])
+                feedIndex = sqlCursor.lastrowid if sqlCursor.rowcount == 1 else None
+        if feedIndex is None:
+            logging.warning("Duplicate URL [" + feed_url + "]")
             return False
-    # Commit changes to DB
-    sqlCon.commit()
-    sqlCon.close()
+        logging.debug("Added [" + feed_url + "] to DB")
+    except Exception as retExc:
+        logging.warning(retExc)
+        return False
     return True
 
 
+# Add multiple feeds to database
+def add_feeds_bulk(feed_urls: list[str]) -> int:
+    """Adds all the valid and not duplicated RSS feeds with a single transaction"""
+    sqlCon = get_sql_connector()
+    existing_urls = {x[0] for x in sqlCon.execute(SQL_LIST_FEED_URLS).fetchall()}
+    # Clean input and skip duplicates
+    new_urls = []
+    for feed_url in dict.fromkeys(x.strip() for x in feed_urls):
+        if not feed_url:
+            continue
+        if feed_url in existing_urls:
+            logging.warning("Duplicate URL [" + feed_url + "]")
+        else:
+            new_urls.append(feed_url)
+    # Validate the new feeds
+    valid_urls = []
+    for feed_url, is_valid in zip(new_urls, feeds.valid_xml_list(new_urls)):
+        if is_valid:
+            valid_urls.append(feed_url)
+        else:
+            logging.warning("RSS feed [" + feed_url + "] cannot be validated")
+    # Store all the feeds with a single commit
+    with sqlCon:
+        sqlCursor = sqlCon.executemany(SQL_INS_FEED, [(x,) for x in valid_urls])
+    added_feeds = max(sqlCursor.rowcount, 0)
+    logging.info("Added [" + str(added_feeds) + "] feeds to DB")
+    return added_feeds
+
+
 # Import all feeds from OPML file
 def opml_import_xmlfeeds(opml_content) -> int:
-    """Loop in the OPML file and add each valid feed"""
-    root = ET.fromstring(opml_content)
-    imported_feeds = 0
-    for outline in root.findall(".//outline"):
-        xmlFeed = outline.get("xmlUrl")  # Use "xmlUrl" to find xmlFeed
-        if xmlFeed:
-            if add_feed_if_not_duplicate(xmlFeed):
-                imported_feeds += 1
-    return imported_feeds
+    """Loop in the OPML file (text, bytes or binary file object) and add each valid feed"""
+    if isinstance(opml_content, str):
+        opml_content = opml_content.encode("utf-8")
+    if isinstance(opml_content, bytes):
+        opml_content = io.BytesIO(opml_content)
+    # Stream the outlines instead of building the whole tree
+    feed_urls = []
+    for _, element in ET.iterparse(opml_content):
+        if element.tag == "outline":
+            xmlFeed = element.get("xmlUrl")  # Use "xmlUrl" to find xmlFeed
+            if xmlFeed:
+                feed_urls.append(xmlFeed)
+            element.clear()
+    return add_feeds_bulk(feed_urls)
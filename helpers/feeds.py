@@ -1,25 +1,71 @@
 """RSS/Atom feed downloading, parsing and validation helpers."""
 
+import io
 import logging
-import xml.dom.minidom
-from typing import List, Optional
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Set
 
+import dateutil.parser
 import feedparser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from .models import NewsFromFeed
+from . import config
+from . import database
+from .models import NewsFromFeed, link_checksum
 from .text_utils import extract_domain, remove_html, remove_links
 
+# Shared HTTP session, keeps connections to the same hosts alive between requests
+_http = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.3))
+_http.mount("http://", _http_adapter)
+_http.mount("https://", _http_adapter)
+
+
+# Parsed entries of the last downloaded feeds, indexed by URL
+_parsed_feeds: dict[str, list] = {}
+
+# Long-lived download workers, each one keeps its own SQLite connection for the feed cache
+_fetch_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="FeedFetch")
+
 
 # Get the content of the RSS feed
 def fetch_feed(url: str) -> Optional[list]:
     """Fetches the feed content from the URL."""
     try:
         logging.debug(f"Downloading RSS feed from [{url}]")
-        response = requests.get(url, timeout=5)
+        # Send a conditional request if we already downloaded this feed
+        request_headers = {}
+        etag, last_modified = database.get_cached_headers(url)
+        if etag:
+            request_headers["If-None-Match"] = etag
+        if last_modified:
+            request_headers["If-Modified-Since"] = last_modified
+        response = _http.get(url, headers=request_headers, timeout=5)
+        if response.status_code == 304:
+            logging.debug(f"Feed at [{url}] was not modified")
+            entries = _parsed_feeds.get(url)
+            if entries is None:
+                entries = feedparser.parse(database.get_cached_body(url))["entries"]
+                _parsed_feeds[url] = entries
+            return entries
         response.raise_for_status()
         logging.debug(f"Retrieved {len(response.content)} bytes from [{url}]")
-        return feedparser.parse(response.content)["entries"]
+        # Let feedparser use the HTTP headers (such as the charset) instead of detecting them again
+        response_headers = {key.lower(): value for key, value in response.headers.items()}
+        entries = feedparser.parse(response.content, response_headers=response_headers)["entries"]
+        # The cache is only useful if the server sent a validator for the next conditional request
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag or last_modified:
+            _parsed_feeds[url] = entries
+            try:
+                database.store_feed_cache(url, etag, last_modified, response.content)
+            except Exception as e:
+                logging.warning(f"Cannot store cache of feed [{url}]. Error message: {str(e)}")
+        return entries
     except requests.RequestException as e:
         logging.error(f"Cannot download feed from [{url}]. Error message: {str(e)}")
     except Exception as e:
@@ -70,11 +116,23 @@ def extract_feed_content(entry, content_key: str) -> Optional[str]:
 
 
 # Pack the properties to a custom class
-def create_article(entry, content_key: str, author_key: str, date_key: str) -> Optional[NewsFromFeed]:
-    """Creates a NewsFromFeed object from an entry."""
+def create_article(entry, content_keys: List[str], author_key: str, date_key: str, max_age: timedelta) -> Optional[NewsFromFeed]:
+    """Creates a NewsFromFeed object from an entry, using the first content key with a valid value."""
     try:
-        logging.debug(f"Attempting to create article from [{entry['link']}] with content_key [{content_key}, {author_key}, {date_key}]")
-        feed_content = extract_feed_content(entry, content_key)
+        logging.debug(f"Attempting to create article from [{entry['link']}] with content_keys [{content_keys}, {author_key}, {date_key}]")
+        # Try to get date from specified date_key, with fallbacks for common date fields
+        date = entry.get(date_key) or entry.get("published") or entry.get("updated")
+        logging.debug(f"Getting date with [{date_key}] returned: [{date}]")
+        if not date:
+            logging.warning(f"Cannot get a valid date using [{date_key}], tried fallbacks 'published' and 'updated'.")
+            return None
+        # Check the date before any expensive processing of the content
+        parsed_date = dateutil.parser.parse(date).replace(tzinfo=None)
+        if datetime.now() - parsed_date > max_age:
+            logging.debug(f"Article: [{entry['link']}] is older than [{max_age.days}] days, skipping")
+            return None
+        # Fall back to the next content field if one is empty or too short once cleaned
+        feed_content = next((x for x in (extract_feed_content(entry, key) for key in content_keys) if x), None)
         if feed_content:
             logging.debug(f"Feed content length: [{len(str(feed_content))}]")
             # Try to get author from the feed, if empty return the domain name
@@ -90,16 +148,10 @@ def create_article(entry, content_key: str, author_key: str, date_key: str) -> O
             # Try to get the link
             link = entry["link"]
             logging.debug(f"Link returned: [{link}]")
-            # Try to get date from specified date_key, with fallbacks for common date fields
-            date = entry.get(date_key) or entry.get("published") or entry.get("updated")
-            logging.debug(f"Getting date with [{date_key}] returned: [{date}]")
             # Build the news class and return it
-            if date:
-                parsed_feed = NewsFromFeed(title, date, author, feed_content, link)
-                logging.debug(f"Feed was properly built, feed content: [{parsed_feed}]")
-                return parsed_feed
-            else:
-                logging.warning(f"Cannot get a valid date using [{date_key}], tried fallbacks 'published' and 'updated'.")
+            parsed_feed = NewsFromFeed(title, parsed_date, author, feed_content, link)
+            logging.debug(f"Feed was properly built, feed content: [{parsed_feed}]")
+            return parsed_feed
         else:
             logging.warning(f"No valid content for [{entry['link']}]. Skipping entry.")
     except KeyError as e:
@@ -110,36 +162,59 @@ def create_article(entry, content_key: str, author_key: str, date_key: str) -> O
 
 
 # Main parsing function
-def parse_news(urls_list: List[str]) -> List[NewsFromFeed]:
-    """Parses RSS feeds from a list of URLs and returns a list of NewsFromFeed objects."""
+def parse_news(urls_list: List[str], sent_filter: Optional[Callable[[List[str]], Set[str]]] = None) -> List[NewsFromFeed]:
+    """Parses RSS feeds from a list of URLs and returns a list of NewsFromFeed objects, skipping the checksums returned by sent_filter."""
+    # Skip duplicated sources
+    urls_list = list(dict.fromkeys(urls_list))
     urls_count = len(urls_list)
     logging.info(f"Parsing news from [{urls_count}] sources, please wait...")
-    fetched_feeds = [feed for url in urls_list if (feed := fetch_feed(url))]
+    # Forget the entries of feeds which were removed
+    for cached_url in _parsed_feeds.keys() - set(urls_list):
+        del _parsed_feeds[cached_url]
+    if urls_count < 1:
+        return []
+    # Download feeds in parallel, network latency dominates here
+    fetched_feeds = [feed for feed in _fetch_pool.map(fetch_feed, urls_list) if feed]
     feeds_counter = 1
-    news_list = []
+    # Checksums of the links already processed during this run
+    seen_links = set()
+    new_entries = []
+    entries_checksums = []
     for feed in fetched_feeds:
-        logging.debug(f"Parsing feed [{feeds_counter}/{len(fetched_feeds)}]")
+        logging.debug(f"Collecting entries of feed [{feeds_counter}/{len(fetched_feeds)}]")
         feeds_counter += 1
         for entry in feed:
-            try:
-                logging.debug(f"Processing entry for [{entry['link']}]")
-                # Try each possible format key for content, author, and date; stop after first successful one
-                for content_key, author_key, date_key in [
-                    ("description", "dc:creator", "pubDate"),
-                    ("summary", "author", "published"),
-                    ("content", "author", "published")
-                ]:
-                    logging.debug(f"Parsing feed using: {content_key}, {author_key}, {date_key}")
-                    article = create_article(entry, content_key, author_key, date_key)
-                    logging.debug(f"Create article returned: {len(str(article))} bytes")
-                    if article is not None:
-                        logging.debug(f"Successfully created article for [{entry['link']}] with content_key [{content_key}]")
-                        news_list.append(article)
-                        break
-                    else:
-                        logging.debug(f"Attempt to create article with content_key [{content_key}] failed for [{entry['link']}]")
-            except Exception as ex:
-                logging.warning(f"Failed to parse article: {ex}")
+            # Same normalization as the stored checksum, so case and whitespace differences are duplicates too
+            checksum = link_checksum(entry.get("link") or "")
+            if checksum in seen_links:
+                logging.debug(f"Skipping duplicated entry for [{entry.get('link')}]")
+                continue
+            seen_links.add(checksum)
+            new_entries.append(entry)
+            entries_checksums.append(checksum)
+    # Skip entries which were already sent, before any expensive processing
+    if sent_filter is not None:
+        sent_checksums = sent_filter(entries_checksums)
+        new_entries = [entry for entry, checksum in zip(new_entries, entries_checksums) if checksum not in sent_checksums]
+        logging.debug(f"Found [{len(new_entries)}] entries which were not sent yet")
+    max_age = timedelta(days=config.get_max_news_days_from_env())
+    news_list = []
+    for entry in new_entries:
+        try:
+            logging.debug(f"Processing entry for [{entry['link']}]")
+            # Only the populated content fields are tried, feedparser already maps "description", "dc:creator" and "pubDate"
+            content_keys = [key for key in ("summary", "content") if entry.get(key)]
+            if not content_keys:
+                logging.debug(f"Cannot find any content in entry for [{entry['link']}]")
+                continue
+            article = create_article(entry, content_keys, "author", "published", max_age)
+            if article is not None:
+                logging.debug(f"Successfully created article for [{entry['link']}]")
+                news_list.append(article)
+            else:
+                logging.debug(f"Attempt to create article with content_keys [{content_keys}] failed for [{entry['link']}]")
+        except Exception as ex:
+            logging.warning(f"Failed to parse article: {ex}")
 
     logging.info(f"Fetched and processed [{len(news_list)}] news items")
     return sorted(news_list, key=lambda news: news.date, reverse=True)
@@ -147,18 +222,38 @@ def parse_news(urls_list: List[str]) -> List[NewsFromFeed]:
 
 # Check if valid XML
 def valid_xml(inputUrl: str) -> bool:
-    """Check if XML has valid syntax"""
+    """Check if the URL returns an XML feed (RSS, Atom or RDF)"""
     try:
-        getRes = requests.get(inputUrl, timeout=5)
-        xml.dom.minidom.parseString(getRes.content)
-        return True
+        # Only the beginning of the document is needed to find the root element
+        with _http.get(inputUrl, headers={"Range": "bytes=0-8191", "Accept-Encoding": "identity"}, timeout=5, stream=True) as getRes:
+            getRes.raise_for_status()
+            getRes.raw.decode_content = True
+            for _, element in ET.iterparse(getRes.raw, events=("start",)):
+                # Strip the namespace, if any
+                return element.tag.rsplit("}", 1)[-1] in ("rss", "feed", "RDF")
+        return False
     except:
         return False
 
 
+# Check multiple XML feeds
+def valid_xml_list(urls_list: List[str]) -> List[bool]:
+    """Check in parallel if each URL has a valid XML syntax"""
+    if len(urls_list) < 1:
+        return []
+    # Validation is network bound, run the downloads concurrently
+    with ThreadPoolExecutor(max_workers=min(20, len(urls_list))) as executor:
+        return list(executor.map(valid_xml, urls_list))
+
+
 # Download a file from an URL
-def file_download(url):
-    """Read the content of any URL and return the text"""
-    response = requests.get(url, timeout=5)
-    response.raise_for_status()  # Check if the request was successful
-    return response.text
+def file_download(url) -> io.BytesIO:
+    """Read the content of any URL and return it as a binary buffer"""
+    with _http.get(url, stream=True, headers={"Accept-Encoding": "gzip"}, timeout=30) as response:
+        response.raise_for_status()  # Check if the request was successful
+        # Read in chunks, the content is decompressed on the fly
+        downloaded_content = io.BytesIO()
+        for content_chunk in response.iter_content(65536):
+            downloaded_content.write(content_chunk)
+    downloaded_content.seek(0)
+    return downloaded_content
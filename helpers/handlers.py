@@ -1,6 +1,10 @@
 """Telegram command handlers (admin-only configuration commands)."""
 
+import functools
 import logging
+import os
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 import telebot
@@ -9,7 +13,225 @@ from . import bot
 from . import config
 from . import database
 from .core import main
-from .feeds import file_download, valid_xml
+from .feeds import file_download, valid_xml_list
+from .text_utils import normalize_url
+
+
+# Workers running the commands, so that the polling thread is never blocked
+CMD_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Command")
+
+
+# Log errors of the commands
+def _log_command_errors(commandFuture: Future) -> None:
+    """Report exceptions raised while running a command"""
+    if commandFuture.exception() is not None:
+        logging.error("Error while running command: %s", commandFuture.exception())
+
+
+# Run command on the workers
+def _submit_command(commandFunction, inputMessage: telebot.types.Message) -> None:
+    """Process the command on the workers pool"""
+    CMD_POOL.submit(commandFunction, inputMessage).add_done_callback(_log_command_errors)
+
+
+# Accept commands only from the admin
+def admin_only(handlerFunction):
+    """Skip the handler for messages which were not sent by the admin"""
+    @functools.wraps(handlerFunction)
+    def wrapper(inputMessage: telebot.types.Message):
+        if inputMessage.from_user.id != config.get_admin_chat_from_env():
+            logging.debug("Ignoring [%s] message from [%s]", inputMessage.text, inputMessage.from_user.id)
+            return
+        return handlerFunction(inputMessage)
+    return wrapper
+
+
+# Handle LIST command
+def _do_urllist(inputMessage: telebot.types.Message) -> None:
+    """Send the list of RSS feeds"""
+    logging.debug("URL list requested from [%s]", inputMessage.from_user.id)
+    sqlCon = database.get_sql_connector()
+    feedsFromDb = [(x[0], x[1]) for x in sqlCon.cursor().execute(database.SQL_LIST_FEEDS).fetchall()]
+    if len(feedsFromDb) < 1:
+        bot.send("reply_to", inputMessage, "No URLs in the url table")
+    else:
+        textMessage: str = ""
+        for singleElement in feedsFromDb:
+            # Check if message is longer than max length
+            if len(textMessage) + len(singleElement[1]) + 10 >= 4096:
+                bot.send("send_message", inputMessage.from_user.id, textMessage)
+                textMessage = ""
+            textMessage += f"{singleElement[0]}: {singleElement[1]}\n"
+        bot.send("send_message", inputMessage.from_user.id, textMessage)
+
+
+# Add new feed to the store
+def _do_addfeed(inputMessage: telebot.types.Message) -> None:
+    """Add a new RSS feed"""
+    # Check arguments count before splitting the command
+    if inputMessage.text.count(" ") == 1:
+        _, _, feedUrl = inputMessage.text.partition(" ")
+        # Check if URL is valid
+        if "http" not in feedUrl:
+            logging.warning("Invalid URL [%s]", feedUrl)
+            bot.send("reply_to", inputMessage, "Invalid URL format")
+            return
+        logging.debug("Feed add requested from [%s]", inputMessage.from_user.id)
+        # Check if feed already exists
+        if database.add_feed_if_not_duplicate(feedUrl):
+            bot.send("reply_to", inputMessage, "Added successfully!")
+        else:
+            bot.send("reply_to", inputMessage, "RSS feed cannot be validated (invalid syntax, unreachable or duplicated)")
+    else:
+        logging.warning("Invalid AddFeed arguments [%s]", inputMessage.text)
+        bot.send("reply_to", inputMessage, "Expecting only one argument")
+
+
+# Remove feed from the stores
+def _do_rmfeed(inputMessage: telebot.types.Message) -> None:
+    """Remove a RSS feed"""
+    # Check arguments count before splitting the command
+    if inputMessage.text.count(" ") == 1:
+        _, _, feedIndex = inputMessage.text.partition(" ")
+        if (feedIndex.isnumeric()):
+            logging.debug("Feed deletion requested from [%s]", inputMessage.from_user.id)
+            try:
+                sqlCon = database.get_sql_connector()
+                with sqlCon:
+                    sqlCon.execute(database.SQL_DEL_FEED, [feedIndex])
+                bot.send("reply_to", inputMessage, "Element was removed successfully!")
+            except Exception as retExc:
+                bot.send("reply_to", inputMessage, retExc)
+        else:
+            bot.send("reply_to", inputMessage, f"[{feedIndex}] is not a valid numeric index")
+    else:
+        bot.send("reply_to", inputMessage, "Expecting only one argument")
+
+
+# Force bot execution
+def _do_force(inputMessage: telebot.types.Message) -> None:
+    """Force a bot execution"""
+    logging.debug("Manual bot execution requested from [%s]", inputMessage.from_user.id)
+    bot.send("reply_to", inputMessage, "Forcing bot execution")
+    main()
+
+
+# Remove old news
+def _do_rmoldnews(inputMessage: telebot.types.Message) -> None:
+    """Remove the old news"""
+    logging.debug("Manual news deletion requested from [%s]", inputMessage.from_user.id)
+    # Check arguments count before splitting the command
+    if inputMessage.text.count(" ") != 1:
+        bot.send("reply_to", inputMessage, "Expecting only one argument")
+        return
+    _, _, maxDays = inputMessage.text.partition(" ")
+    if maxDays.isdigit():
+        deletedNews = database.remove_old_news(int(maxDays))
+        if deletedNews >= 0:
+            bot.send("reply_to", inputMessage, f"Deleting [{deletedNews}] news older than [{maxDays}] days")
+        else:
+            bot.send("reply_to", inputMessage, "Cannot delete older news, check log for error details")
+    else:
+        bot.send("reply_to", inputMessage, "Invalid number of days to delete")
+
+
+# Add from CSV list
+def _do_addcsv(inputMessage: telebot.types.Message) -> None:
+    """Add the RSS feeds from a CSV list"""
+    logging.debug("Adding news from CSV list")
+
+    _, _, csvList = inputMessage.text.partition(" ")
+    # Invalid syntax
+    if not csvList:
+        bot.send("reply_to", inputMessage, "Missing CSV list")
+        return
+    splitCsv = csvList.split(",")
+    # Not enough elements
+    if len(splitCsv) <= 1:
+        bot.send("reply_to", inputMessage, "Expecting more than 1 value in CSV format")
+        return
+    bot.send("reply_to", inputMessage, "Processing, please be patient...")
+    # Add all the feeds which are not existing
+    newFeedsCnt = database.add_feeds_bulk(splitCsv)
+    # Send reply
+    bot.send("reply_to", inputMessage, f"[{newFeedsCnt}] out of [{len(splitCsv)}] feeds were added to DB")
+
+
+# Perform DB cleanup (duplicate and invalid)
+def _do_dbcleanup(inputMessage: telebot.types.Message) -> None:
+    """Remove duplicated and invalid RSS feeds"""
+    logging.debug("Peforming news cleanup")
+    bot.send("reply_to", inputMessage, "Performing cleanup, please be patient...")
+    sqlCon = database.get_sql_connector()
+    feedsFromDb = sqlCon.execute(database.SQL_LIST_FEEDS).fetchall()
+    # Feeds to remove, deleted in a single transaction at the end
+    duplicateIds = []
+    invalidIds = []
+    # First feed found for each normalized URL
+    firstFeeds = {}
+    # Non duplicated feeds, to be validated
+    candidateFeeds = []
+    for singleElement in feedsFromDb:
+        cleanUrl = normalize_url(singleElement[1])
+        logging.debug("Checking for duplicate [%s]", cleanUrl)
+        if cleanUrl in firstFeeds:
+            # Remove duplicate
+            logging.info("Removing duplicate [%s] from DB", singleElement[1])
+            duplicateIds.append(singleElement[0])
+        else:
+            firstFeeds[cleanUrl] = singleElement[0]
+            candidateFeeds.append(singleElement)
+    # Check if feeds are valid
+    for singleElement, isValid in zip(candidateFeeds, valid_xml_list([x[1] for x in candidateFeeds])):
+        if not isValid:
+            # Remove invalid
+            logging.info("Removing invalid [%s] from DB", singleElement[1])
+            invalidIds.append(singleElement[0])
+    # Delete all the feeds with a single commit
+    with sqlCon:
+        sqlCon.executemany(database.SQL_DEL_FEED, [(x,) for x in duplicateIds + invalidIds])
+    # Return output
+    bot.send("reply_to", inputMessage, f"Removed [{len(invalidIds)}] invalid and [{len(duplicateIds)}] duplicated RSS feeds")
+
+
+# Perform DB backup
+def _do_sqlitebackup(inputMessage: telebot.types.Message) -> None:
+    """Send a backup of the sqlite store"""
+    logging.debug("Manual DB backup requested from [%s]", inputMessage.from_user.id)
+    try:
+        with tempfile.TemporaryDirectory() as backupDir:
+            backupPath = os.path.join(backupDir, "frlbot.db")
+            database.backup_db(backupPath)
+            with open(backupPath, "rb") as dbFile:
+                # Wait for the upload, the file is deleted afterwards
+                bot.send("send_document",
+                         chat_id=inputMessage.chat.id,
+                         document=dbFile,
+                         reply_to_message_id=inputMessage.id,
+                         caption=f"SQLite backup at {datetime.now()}").result()
+    except Exception as retExc:
+        bot.send("reply_to", inputMessage, f"Error: {retExc}")
+
+
+# Parse OPML file
+def _do_importopml(inputMessage: telebot.types.Message) -> None:
+    """Import the RSS feeds from an OPML file"""
+    logging.debug("OPML file import requested from [%s]", inputMessage.from_user.id)
+    # Check arguments count before splitting the command
+    if inputMessage.text.count(" ") != 1:
+        bot.send("reply_to", inputMessage, f"Command length is invalid, found {inputMessage.text.count(' ') + 1} arguments")
+        logging.warning("Invalid OPML import command received: %s", inputMessage)
+        return
+    _, _, opmlUrl = inputMessage.text.partition(" ")
+    bot.send("reply_to", inputMessage, "Starting OPML file import, please wait")
+    logging.info("Starting OPML import of [%s]", opmlUrl)
+    # Parse OPML file
+    try:
+        opml_content = file_download(opmlUrl)
+        imported_feeds = database.opml_import_xmlfeeds(opml_content)
+        bot.send("reply_to", inputMessage, f"Imported {imported_feeds} feeds")
+    except Exception as retExc:
+        bot.send("reply_to", inputMessage, f"Error: {retExc}")
 
 
 def register_handlers() -> None:
@@ -18,206 +240,54 @@ def register_handlers() -> None:
 
     # Handle LIST command
     @telegramBot.message_handler(content_types=["text"], commands=['urllist'])
+    @admin_only
     def HandleUrlListMessage(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("URL list requested from [" + str(inputMessage.from_user.id) + "]")
-            sqlCon = database.get_sql_connector()
-            feedsFromDb = [(x[0], x[1]) for x in sqlCon.cursor().execute("SELECT rowid, url FROM feeds WHERE 1").fetchall()]
-            sqlCon.close()
-            if len(feedsFromDb) < 1:
-                telegramBot.reply_to(inputMessage, "No URLs in the url table")
-            else:
-                textMessage: str = ""
-                for singleElement in feedsFromDb:
-                    # Check if message is longer than max length
-                    if len(textMessage) + len(singleElement[1]) + 10 >= 4096:
-                        telegramBot.send_message(inputMessage.from_user.id, textMessage)
-                        textMessage = ""
-                    textMessage += str(singleElement[0]) + ": " + singleElement[1] + "\n"
-                telegramBot.send_message(inputMessage.from_user.id, textMessage)
-        else:
-            logging.debug("Ignoring [" + inputMessage.text + "] message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_urllist, inputMessage)
 
     # Add new feed to the store
     @telegramBot.message_handler(content_types=["text"], commands=['addfeed'])
+    @admin_only
     def HandleAddMessage(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            sqlCon = database.get_sql_connector()
-            splitText = inputMessage.text.split(" ")
-            if (len(splitText) == 2):
-                # Check if URL is valid
-                if "http" not in splitText[1]:
-                    logging.warning("Invalid URL [" + splitText[1] + "]")
-                    telegramBot.reply_to(inputMessage, "Invalid URL format")
-                    return
-                logging.debug("Feed add requested from [" + str(inputMessage.from_user.id) + "]")
-                # Check if feed already exists
-                if database.add_feed_if_not_duplicate(splitText[1]):
-                    telegramBot.reply_to(inputMessage, "Added successfully!")
-                else:
-                    telegramBot.reply_to(inputMessage, "RSS feed cannot be validated (invalid syntax, unreachable or duplicated)")
-            else:
-                logging.warning("Invalid AddFeed arguments [" + inputMessage.text + "]")
-                telegramBot.reply_to(inputMessage, "Expecting only one argument")
-        else:
-            logging.debug("Ignoring [" + inputMessage.text + "] message from [" + str(inputMessage.from_user.id) + "]")
-        # Close DB connection
-        sqlCon.close()
+        _submit_command(_do_addfeed, inputMessage)
 
     # Remove feed from the stores
     @telegramBot.message_handler(content_types=["text"], commands=['rmfeed'])
+    @admin_only
     def HandleRemoveMessage(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            sqlCon = database.get_sql_connector()
-            splitText = inputMessage.text.split(" ")
-            if (len(splitText) == 2):
-                if (splitText[1].isnumeric()):
-                    logging.debug("Feed deletion requested from [" + str(inputMessage.from_user.id) + "]")
-                    try:
-                        sqlCon.execute("DELETE FROM feeds WHERE rowid=?", [splitText[1]])
-                        sqlCon.commit()
-                        sqlCon.close()
-                        telegramBot.reply_to(inputMessage, "Element was removed successfully!")
-                    except Exception as retExc:
-                        telegramBot.reply_to(inputMessage, retExc)
-                else:
-                    telegramBot.reply_to(inputMessage, "[" + splitText[1] + "] is not a valid numeric index")
-            else:
-                telegramBot.reply_to(inputMessage, "Expecting only one argument")
-        else:
-            logging.debug("Ignoring [" + inputMessage.text + "] message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_rmfeed, inputMessage)
 
     # Force bot execution
     @telegramBot.message_handler(content_types=["text"], commands=['force'])
+    @admin_only
     def HandleForceMessage(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("Manual bot execution requested from [" + str(inputMessage.from_user.id) + "]")
-            telegramBot.reply_to(inputMessage, "Forcing bot execution")
-            main()
-        else:
-            logging.debug("Ignoring [" + inputMessage.text + "] message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_force, inputMessage)
 
     # Remove old news
     @telegramBot.message_handler(content_types=["text"], commands=['rmoldnews'])
+    @admin_only
     def HandleOldNewsDelete(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("Manual news deletion requested from [" + str(inputMessage.from_user.id) + "]")
-            splitMessage = inputMessage.text.split(" ")
-            if len(splitMessage) != 2:
-                telegramBot.reply_to(inputMessage, "Expecting only one argument")
-            elif splitMessage[1].isdigit():
-                deletedNews = database.remove_old_news(int(splitMessage[1]))
-                if deletedNews >= 0:
-                    telegramBot.reply_to(inputMessage, "Deleting [" + str(deletedNews) + "] news older than [" + str(splitMessage[1]) + "] days")
-                else:
-                    telegramBot.reply_to(inputMessage, "Cannot delete older news, check log for error details")
-            else:
-                telegramBot.reply_to(inputMessage, "Invalid number of days to delete")
-        else:
-            logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_rmoldnews, inputMessage)
 
     # Add from CSV list
     @telegramBot.message_handler(content_types=["text"], commands=['addcsv'])
+    @admin_only
     def HandleAddCsvList(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("Adding news from CSV list")
-
-            splitMessage = inputMessage.text.split("/addcsv")
-            # Invalid syntax
-            if len(splitMessage) <= 1:
-                telegramBot.reply_to(inputMessage, "Missing CSV list")
-                return
-            splitCsv = splitMessage[1].split(",")
-            # Not enough elements
-            if len(splitCsv) <= 1:
-                telegramBot.reply_to(inputMessage, "Expecting more than 1 value in CSV format")
-                return
-            telegramBot.reply_to(inputMessage, "Processing, please be patient...")
-            newFeedsCnt = 0
-            for singleUrl in splitCsv:
-                # Clean input string
-                singleUrl = singleUrl.strip()
-                # Add feed if not existing
-                if (database.add_feed_if_not_duplicate(singleUrl)):
-                    newFeedsCnt += 1
-            # Send reply
-            telegramBot.reply_to(inputMessage, "[" + str(newFeedsCnt) + "] out of [" + str(len(splitCsv)) + "] feeds were added to DB")
-        else:
-            logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_addcsv, inputMessage)
 
     # Perform DB cleanup (duplicate and invalid)
     @telegramBot.message_handler(content_types=["text"], commands=['dbcleanup'])
+    @admin_only
     def HandleDbCleanup(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("Peforming news cleanup")
-            telegramBot.reply_to(inputMessage, "Performing cleanup, please be patient...")
-            sqlCon = database.get_sql_connector()
-            feedsFromDb = [(x[0], x[1]) for x in sqlCon.cursor().execute("SELECT rowid, url FROM feeds WHERE 1").fetchall()]
-            duplicatesCnt = 0
-            invalidsCnt = 0
-            for singleElement in feedsFromDb:
-                cleanUrl = singleElement[1].split("://")[1].replace("www.", "")
-                logging.debug("Checking for duplicate [" + cleanUrl + "]")
-                # Query to check for duplicate URLs with a different rowid
-                query = "SELECT rowid FROM feeds WHERE url LIKE ? AND rowid != ?"
-                # Execute the query
-                duplicates = sqlCon.cursor().execute(query, ("%" + cleanUrl + "%", singleElement[0])).fetchall()
-                if duplicates:
-                    # Remove duplicate
-                    logging.info("Removing duplicate [" + singleElement[1] + "] from DB")
-                    sqlCon.execute("DELETE FROM feeds WHERE rowid=?", [singleElement[0]])
-                    sqlCon.commit()
-                    duplicatesCnt += 1
-                else:
-                    # Check if feed is valid
-                    if not valid_xml(singleElement[1]):
-                        # Remove duplicate
-                        logging.info("Removing invalid [" + singleElement[1] + "] from DB")
-                        sqlCon.execute("DELETE FROM feeds WHERE rowid=?", [singleElement[0]])
-                        sqlCon.commit()
-                        invalidsCnt += 1
-            # Close DB connection
-            sqlCon.close()
-            # Return output
-            telegramBot.reply_to(inputMessage, "Removed [" + str(invalidsCnt) + "] invalid and [" + str(duplicatesCnt) + "] duplicated RSS feeds")
-        else:
-            logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_dbcleanup, inputMessage)
 
     # Perform DB backup
     @telegramBot.message_handler(content_types=["text"], commands=['sqlitebackup'])
+    @admin_only
     def HandleSqliteBackup(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("Manual DB backup requested from [" + str(inputMessage.from_user.id) + "]")
-            try:
-                dbFile = open("store/frlbot.db", "rb")
-                telegramBot.send_document(chat_id=inputMessage.chat.id,
-                                          document=dbFile,
-                                          reply_to_message_id=inputMessage.id,
-                                          caption="SQLite backup at " + str(datetime.now()))
-            except Exception as retExc:
-                telegramBot.reply_to(inputMessage, "Error: " + str(retExc))
-        else:
-            logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_sqlitebackup, inputMessage)
 
     # Parse OPML file
     @telegramBot.message_handler(content_types=["text"], commands=['importopml'])
+    @admin_only
     def HandleImportOPML(inputMessage: telebot.types.Message):
-        if inputMessage.from_user.id == config.get_admin_chat_from_env():
-            logging.debug("OPML file import requested from [" + str(inputMessage.from_user.id) + "]")
-            splitText = inputMessage.text.split(" ")
-            if len(splitText) != 2:
-                telegramBot.reply_to(inputMessage, f"Command length is invalid, found {len(splitText)} arguments")
-                logging.warning(f"Invalid OPML import command received: {inputMessage}")
-                return
-            else:
-                telegramBot.reply_to(inputMessage, f"Starting OPML file import, please wait")
-                logging.info(f"Starting OPML import of [{splitText[1]}]")
-            # Parse OPML file
-            try:
-                opml_content = file_download(splitText[1])
-                imported_feeds = database.opml_import_xmlfeeds(opml_content)
-                telegramBot.reply_to(inputMessage, f"Imported {imported_feeds} feeds")
-            except Exception as retExc:
-                telegramBot.reply_to(inputMessage, "Error: " + str(retExc))
-        else:
-            logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        _submit_command(_do_importopml, inputMessage)
@@ -7,6 +7,18 @@ from datetime import datetime
 
 import dateutil.parser
 
+# Matches any run of blank characters (spaces, tabs, line feeds)
+_WS_RE = re.compile(r'\s+')
+# Matches the "Read more" text appended by some feeds
+_READ_MORE_RE = re.compile(re.escape("read more"), re.IGNORECASE)
+
+
+# Calculate the checksum of a news
+def link_checksum(inputLink: str) -> str:
+    """Return the checksum used to identify a news from its link"""
+    clean_url = inputLink.strip().lower()
+    return hashlib.md5(clean_url.encode('utf-8'), usedforsecurity=False).hexdigest()
+
 
 # Create news class
 class NewsFromFeed(list):
@@ -18,27 +30,25 @@ class NewsFromFeed(list):
     link: str = ""
     checksum: str = ""
 
-    def __init__(self, inputTitle: str, inputDate: str, inputAuthor: str, inputSummary: str, inputLink: str = "") -> None:
+    def __init__(self, inputTitle: str, inputDate: str | datetime, inputAuthor: str, inputSummary: str, inputLink: str = "") -> None:
         self.title = inputTitle.strip()
         logging.debug(f"Class title: [{self.title}]")
-        self.date = dateutil.parser.parse(inputDate).replace(tzinfo=None)
+        if isinstance(inputDate, datetime):
+            self.date = inputDate.replace(tzinfo=None)
+        else:
+            self.date = dateutil.parser.parse(inputDate).replace(tzinfo=None)
         logging.debug(f"Class date: [{self.date}]")
         self.author = inputAuthor.strip()
         logging.debug(f"Class author: [{self.author}]")
         if len(inputSummary) > 10:
             # Remove "Read more"
-            regex_read_more = re.compile(re.escape("read more"), re.IGNORECASE)
-            # Parse summary
-            no_read_more = re.sub(regex_read_more, "", inputSummary.strip())
+            no_read_more = _READ_MORE_RE.sub("", inputSummary)
         else:
             no_read_more = inputSummary
-        # Remove line feeds
-        cut_text = no_read_more.strip().replace('\n', ' ')
-        # Remove excessive blank spaces
-        while '  ' in cut_text:
-            cut_text = cut_text.replace('  ', ' ')
+        # Remove line feeds and excessive blank spaces
+        cut_text = _WS_RE.sub(' ', no_read_more).strip()
         # Cut input text if too long (Telegram API limitation)
-        if len(no_read_more) > 300:
+        if len(cut_text) > 300:
             cut_text = cut_text[:300] + " ..."
         self.summary = cut_text
         logging.debug(f"Class summary: [{self.summary}]")
@@ -46,7 +56,7 @@ class NewsFromFeed(list):
         self.link = "[" + self.title + "](" + clean_url + ")"
         logging.debug(f"Class url: [{self.link}]")
         # Calculate checksum
-        self.checksum = hashlib.md5(clean_url.encode('utf-8')).hexdigest()
+        self.checksum = link_checksum(clean_url)
         logging.debug(f"Class checksum: [{self.checksum}]")
 
     def __str__(self):
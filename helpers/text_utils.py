@@ -1,28 +1,49 @@
 """Helpers to clean and normalize text coming from the RSS feeds."""
 
 import re
+from urllib.parse import urlsplit
+
+from selectolax.lexbor import LexborHTMLParser
+
+# Matches URLs with or without http/https, including all subdomains
+_LINK_RE = re.compile(r'(?:https?:\/\/)?(?:www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_\+.~#?&//=]*)')
+# Matches the domain name of an URL
+_DOMAIN_RE = re.compile(r'https?://(?:www\.)?([^/]+)')
+# Tags ending a block of text, a space is added after them when stripping the HTML
+_BLOCK_TAGS = "p, div, br, li, tr, td, th, h1, h2, h3, h4, h5, h6, blockquote"
 
 
 # Remove HTML code
 def remove_html(inputText: str) -> str:
     """Remove html code from the news content"""
-    regex_html = re.compile('<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});')
-    return re.sub(regex_html, "", inputText.strip())
+    # The parser also takes care of decoding the HTML entities
+    htmlTree = LexborHTMLParser(inputText)
+    # Keep inline text together (e.g. H<sub>2</sub>O) but separate blocks
+    for blockNode in htmlTree.css(_BLOCK_TAGS):
+        blockNode.insert_after(" ")
+    return htmlTree.text(separator="").strip()
 
 
 # Remove links from text
 def remove_links(inputText: str) -> str:
     """Remove links from the news content"""
-    # This regex matches URLs with or without http/https, including all subdomains
-    regex_link = re.compile(r'(?:https?:\/\/)?(?:www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_\+.~#?&//=]*)')
-    return re.sub(regex_link, "", inputText.strip())
+    return _LINK_RE.sub("", inputText.strip())
 
 
 # Extract domain from URL
 def extract_domain(url):
     """Extract the domain name from an URL"""
-    pattern = r'https?://(?:www\.)?([^/]+)'
-    result = re.match(pattern, url)
+    result = _DOMAIN_RE.match(url)
     if result:
         return result.group(1)
     return "anonymous"
+
+
+# Normalize URL for comparisons
+def normalize_url(url: str) -> str:
+    """Return the URL without scheme and "www." prefix, used to find duplicates"""
+    split_url = urlsplit(url.strip())
+    normalized_url = (split_url.hostname or "").removeprefix("www.") + split_url.path
+    if split_url.query:
+        normalized_url += "?" + split_url.query
+    return normalized_url
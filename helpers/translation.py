@@ -1,32 +1,68 @@
 """Translation helpers built on top of the Google Translate APIs."""
 
+import hashlib
 import logging
+from functools import lru_cache
+from typing import List
 
-from googletrans import Translator
+from deep_translator import GoogleTranslator
 
 from . import config
+from . import database
+
+# Calculate the key of a translation
+def _translation_key(input_text: str, dest_lang: str) -> str:
+    """Hash of the text and destination language"""
+    return hashlib.md5((dest_lang + "|" + input_text).encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+# Load translation from the store
+@lru_cache(maxsize=2048)
+def _load_translation(translation_key: str) -> str:
+    """Return the stored translation, raise KeyError if missing"""
+    # Raising on misses prevents the cache from storing them
+    stored_text = database.get_translation(translation_key)
+    if stored_text is None:
+        raise KeyError(translation_key)
+    return stored_text
 
 
 # Handle translation
-def translate_text(input_text: str, dest_lang: str = "it") -> str:
-    """Translate text using Google APIs"""
+def translate_text(input_texts: List[str], dest_lang: str = "it") -> List[str]:
+    """Translate a list of texts using Google APIs"""
     # Check if skip translations
     if config.no_ai:
-        return input_text
+        return input_texts
+    # Reuse already translated texts
+    translation_keys = [_translation_key(input_text, dest_lang) for input_text in input_texts]
+    translated_texts = list(input_texts)
+    missing_indexes = []
+    for index, translation_key in enumerate(translation_keys):
+        try:
+            translated_texts[index] = _load_translation(translation_key)
+        except KeyError:
+            missing_indexes.append(index)
+    if not missing_indexes:
+        logging.debug("Translations found in store")
+        return translated_texts
     # Start text rework
-    logging.debug("Translating: [" + input_text + "]")
-    translator = Translator()
+    missing_texts = [input_texts[index] for index in missing_indexes]
+    logging.debug("Translating: " + str(missing_texts))
     translator_response = None
     try:
-        translator_response = translator.translate(input_text, dest=dest_lang)
+        # The translator keeps the text of the current request in the instance, do not share it between threads
+        translator_response = GoogleTranslator(source="auto", target=dest_lang).translate_batch(missing_texts)
     except Exception as ret_exc:
         logging.error(str(ret_exc))
-        return input_text
+        return translated_texts
     logging.debug(translator_response)
     if translator_response is None:
         logging.error("Unable to translate text")
-        return input_text
-    elif len(translator_response.text) < 10:
-        logging.error("Translation was too short")
-        return input_text
-    return translator_response.text
+        return translated_texts
+    for index, translated in zip(missing_indexes, translator_response):
+        if not translated or len(translated) < 10:
+            logging.error("Translation was too short")
+        else:
+            translated_texts[index] = translated
+            database.store_translation(translation_keys[index], dest_lang, translated)
+    return translated_texts